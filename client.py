@@ -1,20 +1,22 @@
+import os
+import sys
 import socket
-import json
-import threading
-import time
+from protocol import (
+    STATUS_RECORD, STATE_NAMES, FLAG_WIFI, FLAG_CELLULAR, FLAG_STREAMING,
+    encode, decode, send_framed, recv_framed
+)
 
 class VehicleClient:
-    def __init__(self, host=None, port=65432):
+    def __init__(self, host, port=65432):
         self.host = host
         self.port = port
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # Don't delay small commands
         self.running = False
         self.controlled_vehicle = None
     
     def connect(self):
         try:
-            if self.host is None:
-                self.host = input("Enter server IP address: ")
             self.socket.connect((self.host, self.port))
             self.running = True
             print(f"Connected to server at {self.host}:{self.port}")
@@ -28,9 +30,11 @@ class VehicleClient:
     
     def send_command(self, cmd):
         try:
-            self.socket.sendall(json.dumps(cmd).encode('utf-8'))
-            response = self.socket.recv(1024).decode('utf-8')
-            return json.loads(response)
+            send_framed(self.socket, encode(cmd))
+            response = recv_framed(self.socket)
+            if response is None:
+                raise ConnectionError("Server closed the connection")
+            return decode(response)[1]
         except Exception as e:
             print(f"Error sending command: {e}")
             return {'status': 'error', 'message': str(e)}
@@ -58,17 +62,22 @@ class VehicleClient:
             print("Failed to get vehicle status from server")
             return False
         
-        vehicles = response['data']
+        vehicles = list(STATUS_RECORD.iter_unpack(response['data']))
+        # The server sends records in vehicle_id order, one per id from 0
+        if any(r[0] != i for i, r in enumerate(vehicles)):
+            print("Server sent vehicle records out of order")
+            return False
+        
         print("\nAvailable Vehicles:")
-        for v in sorted(vehicles, key=lambda x: x['vehicle_id']):
-            print(f"Vehicle {v['vehicle_id']} @ {v['position']}")
+        for vehicle_id, x, y, *_ in vehicles:
+            print(f"Vehicle {vehicle_id} @ ({x:g}, {y:g})")
         
         while True:
             try:
                 vid = int(input("\nEnter Vehicle ID you want to control (or -1 to exit): "))
                 if vid == -1:
                     return False
-                if any(v['vehicle_id'] == vid for v in vehicles):
+                if 0 <= vid < len(vehicles):
                     self.controlled_vehicle = vid
                     print(f"\nYou are now controlling Vehicle {vid}")
                     print("Type 'help' for available commands")
@@ -126,24 +135,26 @@ class VehicleClient:
             self.socket.close()
             print("Disconnected from server")
     
-    def print_status(self, vehicles_data):
+    def print_status(self, frame):
         print("\n" + "="*80)
         print("Current Vehicle Status:")
         print("-"*80)
-        for v in sorted(vehicles_data, key=lambda x: x['vehicle_id']):
-            status = "Streaming" if v['is_streaming'] else "Not Streaming"
+        for vehicle_id, x, y, state_code, flags, received_from in STATUS_RECORD.iter_unpack(frame):
+            state = STATE_NAMES[state_code]
+            status = "Streaming" if flags & FLAG_STREAMING else "Not Streaming"
             source = ""
-            if v['state'] == 'DS':
-                source = f" (via Vehicle {v['received_from']})"
-            elif v['state'] == 'CS':
+            if state == 'DS':
+                source = f" (via Vehicle {received_from})"
+            elif state == 'CS':
                 source = " (via Cellular)"
             
             # Highlight the controlled vehicle
-            prefix = ">>> " if v['vehicle_id'] == self.controlled_vehicle else "    "
-            print(prefix + (f"Vehicle {v['vehicle_id']:>2} @ {str(v['position']):<9} | "
-                  f"State: {v['state']:<2} | "
-                  f"WiFi: {'ON ' if v['wifi_available'] else 'OFF'} | "
-                  f"Cellular: {'ON ' if v['cellular_available'] else 'OFF'} | "
+            prefix = ">>> " if vehicle_id == self.controlled_vehicle else "    "
+            position = f"({x:g}, {y:g})"
+            print(prefix + (f"Vehicle {vehicle_id:>2} @ {position:<9} | "
+                  f"State: {state:<2} | "
+                  f"WiFi: {'ON ' if flags & FLAG_WIFI else 'OFF'} | "
+                  f"Cellular: {'ON ' if flags & FLAG_CELLULAR else 'OFF'} | "
                   f"{status}{source}"))
         print("="*80)
     
@@ -156,5 +167,9 @@ class VehicleClient:
         print("exit (quit)      - Disconnect from server")
 
 if __name__ == "__main__":
-    client = VehicleClient()
+    # Server address from argv, then $VNS_SERVER, then an interactive prompt
+    host = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('VNS_SERVER')
+    if not host:
+        host = input("Enter server IP address: ")
+    client = VehicleClient(host)
     client.start_interactive()
\ No newline at end of file
@@ -0,0 +1,65 @@
+import struct
+import msgpack
+import orjson
+
+# Content-type byte prefixed to every message
+MSGPACK = b'M'  # MessagePack (default)
+JSON = b'J'     # JSON (fallback for interop)
+
+# Fixed-width status record, one per vehicle, as (name, struct code) pairs.
+# The server builds its NumPy layout from the same fields.
+STATUS_FIELDS = (
+    ('vehicle_id', 'B'),
+    ('x', 'f'),
+    ('y', 'f'),
+    ('state', 'B'),          # State code
+    ('flags', 'B'),
+    ('received_from', 'b')   # -1 if none
+)
+STATUS_RECORD = struct.Struct('<' + ''.join(code for _, code in STATUS_FIELDS))
+STATE_NAMES = ('WS', 'DS', 'CS', 'NS')  # Indexed by state code
+
+# Bits of the flags byte
+FLAG_WIFI = 0x1
+FLAG_CELLULAR = 0x2
+FLAG_STREAMING = 0x4
+
+def encode(obj, content_type=MSGPACK):
+    if content_type == JSON:
+        return JSON + orjson.dumps(obj)
+    return MSGPACK + msgpack.packb(obj, use_bin_type=True)
+
+def decode(data):
+    """Return (content_type, obj) for a message produced by encode()."""
+    content_type, body = bytes(data[:1]), data[1:]
+    if content_type == MSGPACK:
+        return content_type, msgpack.unpackb(body, raw=False)
+    if content_type == JSON:
+        return content_type, orjson.loads(body)
+    raise ValueError(f"Unknown content type: {content_type!r}")
+
+def frame(payload):
+    """Prefix payload with its 4-byte big-endian length."""
+    return len(payload).to_bytes(4, 'big') + payload
+
+def send_framed(sock, payload):
+    sock.sendall(frame(payload))
+
+def recv_exact(sock, size):
+    """Read exactly size bytes, or return None if the peer closed first."""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+    return buf
+
+def recv_framed(sock):
+    """Read one length-prefixed message, or return None on disconnect."""
+    header = recv_exact(sock, 4)
+    if header is None:
+        return None
+    return recv_exact(sock, int.from_bytes(header, 'big'))
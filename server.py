@@ -1,101 +1,99 @@
 import threading
 import time
-import math
 import socket
-import json
+import selectors
+import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.patches as patches
 from matplotlib.animation import FuncAnimation
-from queue import Queue
+from queue import Queue, Empty
+from collections import deque
+from protocol import (
+    MSGPACK, JSON, STATE_NAMES, STATUS_FIELDS, STATUS_RECORD,
+    FLAG_WIFI, FLAG_CELLULAR, FLAG_STREAMING,
+    encode, decode, frame
+)
 
-# State constants
-WS = "WS"  # WiFi Streaming (self)
-DS = "DS"  # DSRC Streaming (via neighbor)
-CS = "CS"  # Cellular Streaming (fallback)
-NS = "NS"  # Not Streaming
+# State codes, indexing protocol.STATE_NAMES
+WS = 0  # WiFi Streaming (self)
+DS = 1  # DSRC Streaming (via neighbor)
+CS = 2  # Cellular Streaming (fallback)
+NS = 3  # Not Streaming
+
+# Marker colors indexed by state code
+STATE_COLORS_BY_CODE = [
+    '#2ecc71',  # WS: Emerald green
+    '#3498db',  # DS: Peter River blue
+    '#e67e22',  # CS: Carrot orange
+    '#e74c3c'   # NS: Alizarin red
+]
 
 WIFI_RANGE = 30  # Maximum range for WiFi sharing 
+WIFI_RANGE_SQ = WIFI_RANGE * WIFI_RANGE  # Compared against squared distances
+
+# Packed NumPy layout of protocol.STATUS_RECORD, from the same field list
+STATUS_DTYPE = np.dtype([(name, '<' + code) for name, code in STATUS_FIELDS])
+if STATUS_DTYPE.itemsize != STATUS_RECORD.size:
+    raise RuntimeError("STATUS_DTYPE does not match protocol.STATUS_RECORD")
 
 class Vehicle:
-    def __init__(self, vehicle_id, position):
+    """Thin view onto one row of the server's per-vehicle arrays."""
+    def __init__(self, server, vehicle_id):
+        self.server = server
         self.vehicle_id = vehicle_id
-        self.position = position
-        self.state = WS if vehicle_id in {1, 5} else NS
-        self.neighbors = []
-        self.wifi_available = vehicle_id in {1, 5}
-        self.cellular_available = False if vehicle_id == 4 else False
-        self.received_states = {}
-        self.received_from = None
-        self.lock = threading.Lock()
 
-    def is_streaming(self):
-        return self.state in {WS, DS, CS}
+    @property
+    def position(self):
+        x, y = self.server.pos[self.vehicle_id]
+        return (float(x), float(y))
 
-    def broadcast_state(self):
-        with self.lock:
-            for neighbor in self.neighbors:
-                neighbor.receive_state(self.vehicle_id, self.state, self.position)
+    @property
+    def state(self):
+        return int(self.server.state[self.vehicle_id])
 
-    def receive_state(self, sender_id, state, sender_position):
-        with self.lock:
-            distance = math.dist(self.position, sender_position)
-            if distance <= WIFI_RANGE:
-                self.received_states[sender_id] = (state, sender_position)
-
-    def update_state(self):
-        with self.lock:
-            if self.wifi_available:
-                self.state = WS
-                self.cellular_available = False
-                return
-            
-            if self.vehicle_id != 4:
-                self.cellular_available = False
-            
-            nearest_ws = None
-            min_distance = float('inf')
-            
-            for vid, (state, pos) in self.received_states.items():
-                if state == WS:
-                    distance = math.dist(self.position, pos)
-                    if distance <= WIFI_RANGE and distance < min_distance:
-                        nearest_ws = vid
-                        min_distance = distance
-            
-            if nearest_ws is not None:
-                self.state = DS
-                self.received_from = nearest_ws
-            else:
-                if self.vehicle_id == 4:
-                    self.state = NS
-                else:
-                    self.cellular_available = True
-                    self.state = CS if self.cellular_available else NS
-            
-            self.received_states.clear()
+    @property
+    def received_from(self):
+        source = int(self.server.recv_from[self.vehicle_id])
+        return source if source >= 0 else None
 
     def move(self, new_position):
-        with self.lock:
-            self.position = new_position
-        self.update_state()
+        self.server.pos[self.vehicle_id] = new_position
 
-    def to_dict(self):
-        return {
-            'vehicle_id': self.vehicle_id,
-            'position': self.position,
-            'state': self.state,
-            'wifi_available': self.wifi_available,
-            'cellular_available': self.cellular_available,
-            'received_from': self.received_from,
-            'is_streaming': self.is_streaming()
-        }
+class ClientConnection:
+    """Per-client socket and buffers for the selector loop."""
+    def __init__(self, conn, addr):
+        self.conn = conn
+        self.addr = addr
+        self.inbound = bytearray(4096)       # Reused receive buffer
+        self.view = memoryview(self.inbound)
+        self.filled = 0                      # Bytes of inbound not yet framed
+        self.outbound = deque()              # Framed replies not yet sent, oldest first
+
+    def grow(self):
+        # A frame is larger than the buffer; the view must go before resizing
+        self.view.release()
+        self.inbound.extend(bytes(len(self.inbound)))
+        self.view = memoryview(self.inbound)
 
 class SimulationServer:
+    # Constant replies, encoded and framed once per content type
+    _OK_QUEUED = {
+        ct: frame(encode({'status': 'success', 'message': 'Command queued'}, ct))
+        for ct in (MSGPACK, JSON)
+    }
+    _ERR_INVALID = {
+        ct: frame(encode({'status': 'error', 'message': 'Invalid message'}, ct))
+        for ct in (MSGPACK, JSON)
+    }
+    
     def __init__(self):
         self.vehicles = []
         self.running = False
         self.command_queue = Queue()
-        self.lock = threading.Lock()
+        self.state_lock = threading.Lock()  # Guards vehicle state for a whole tick
+        self._status_cache = {}  # Framed status replies by content type
+        self._dirty = True  # Visualization is out of date
+        self._moved = set()  # Vehicles moved since the last recompute
         self.initialize_vehicles()
         self.need_refresh = False  # Flag to force refresh
         
@@ -107,13 +105,6 @@ class SimulationServer:
         self.ax.grid(True, color='white', alpha=0.4)
         self.ax.set_title('Vehicle Network State Visualization', fontsize=16, pad=20)
         
-        self.state_colors = {
-            'WS': '#2ecc71',  # Emerald green
-            'DS': '#3498db',  # Peter River blue
-            'CS': '#e67e22',  # Carrot orange
-            'NS': '#e74c3c'   # Alizarin red
-        }
-        
         self.vehicle_markers = []
         self.connection_lines = []
         self.vehicle_labels = []
@@ -124,7 +115,8 @@ class SimulationServer:
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.host = socket.gethostbyname(socket.gethostname())  # Get local IP
         self.port = 65432
-        self.client_threads = []
+        self.selector = None
+        self.server_thread = None
         self.ani = None
         
     def initialize_vehicles(self):
@@ -137,17 +129,71 @@ class SimulationServer:
             (120, 100)   # Vehicle 5 (Permanent WiFi)
         ]
         
-        self.vehicles = [Vehicle(i, pos) for i, pos in enumerate(positions)]
+        # Struct-of-arrays vehicle state, one row per vehicle
+        n = len(positions)
+        ids = np.arange(n)
+        self.pos = np.array(positions, dtype=np.float32)
+        self.wifi = np.isin(ids, [1, 5])
+        self.cellular_capable = ids != 4
+        self.state = np.where(self.wifi, WS, NS).astype(np.uint8)
+        self.cell = np.zeros(n, dtype=bool)
+        self.recv_from = np.full(n, -1, dtype=np.int8)
+        self.vehicles = [Vehicle(self, i) for i in range(n)]
+        self.recompute_states()
+    
+    def recompute_states(self, rows=None):
+        # Caller must hold self.state_lock; rows=None recomputes every vehicle
+        if rows is None:
+            rows = np.arange(len(self.vehicles))
+        old_state = self.state[rows]
+        old_recv_from = self.recv_from[rows]
+        
+        # Squared distances from each recomputed vehicle to every vehicle; no
+        # sqrt needed since we only compare against the range and pick the nearest
+        diff = self.pos[rows, None, :] - self.pos[None, :, :]
+        dist_sq = (diff * diff).sum(axis=-1)
+        dist_sq[:, self.state != WS] = np.inf  # Only WS vehicles share WiFi
         
-        # Set up neighbor relationships
-        for v in self.vehicles:
-            v.neighbors = [n for n in self.vehicles if n.vehicle_id != v.vehicle_id]
+        nearest = dist_sq.argmin(axis=1)
+        in_range = dist_sq[np.arange(len(rows)), nearest] <= WIFI_RANGE_SQ
+        wifi = self.wifi[rows]
+        ds = ~wifi & in_range
+        cs = ~wifi & ~in_range & self.cellular_capable[rows]
+        
+        state = np.full(len(rows), NS, dtype=np.uint8)
+        state[wifi] = WS
+        state[ds] = DS
+        state[cs] = CS
+        self.state[rows] = state
+        self.recv_from[rows[ds]] = nearest[ds]
+        self.cell[rows] = cs
+        
+        if not (np.array_equal(old_state, self.state[rows]) and
+                np.array_equal(old_recv_from, self.recv_from[rows])):
+            self._status_cache.clear()
+            self._dirty = True
+    
+    def _affected_rows(self):
+        # Vehicles whose state may depend on the positions in self._moved.
+        # Only WS positions matter to others, so a moved non-WS vehicle
+        # affects only itself; a moved WS also affects vehicles it was
+        # serving and vehicles now within range of it.
+        moved = np.fromiter(self._moved, dtype=np.intp)
+        affected = np.zeros(len(self.vehicles), dtype=bool)
+        affected[moved] = True
+        
+        ws_moved = moved[self.wifi[moved]]
+        if ws_moved.size:
+            affected |= np.isin(self.recv_from, ws_moved)
+            diff = self.pos[:, None, :] - self.pos[None, ws_moved, :]
+            affected |= ((diff * diff).sum(axis=-1) <= WIFI_RANGE_SQ).any(axis=1)
+        return np.flatnonzero(affected)
     
     def setup_visualization(self):
-        for v in self.vehicles:
-            color = self.state_colors[v.state]
+        for vid, ((x, y), state) in enumerate(zip(self.pos.tolist(), self.state.tolist())):
+            color = STATE_COLORS_BY_CODE[state]
             marker = self.ax.scatter(
-                v.position[0], v.position[1],
+                x, y,
                 s=400, color=color,
                 edgecolor='black', linewidth=2,
                 zorder=3,
@@ -155,8 +201,8 @@ class SimulationServer:
             )
             
             label = self.ax.text(
-                v.position[0], v.position[1] - 10,
-                f"V{v.vehicle_id}",
+                x, y - 10,
+                f"V{vid}",
                 ha='center', va='center',
                 fontsize=12, fontweight='bold',
                 color='black',
@@ -170,15 +216,26 @@ class SimulationServer:
                 )
             )
             
+            # One reusable DSRC line per vehicle, empty until it connects
+            line, = self.ax.plot(
+                [], [],
+                color='#3498db', linestyle='--',
+                linewidth=2.5, alpha=0.7,
+                zorder=2
+            )
+            
             self.vehicle_markers.append(marker)
-            self.connection_lines.append(None)
+            self.connection_lines.append(line)
             self.vehicle_labels.append(label)
+        
+        # The animated artists never change, so build the list once
+        self._cached_artists = self.vehicle_markers + self.vehicle_labels + self.connection_lines
             
         legend_elements = [
-            patches.Patch(color='#2ecc71', label='WS (WiFi Source)'),
-            patches.Patch(color='#3498db', label='DS (DSRC Connected)'),
-            patches.Patch(color='#e67e22', label='CS (Cellular)'),
-            patches.Patch(color='#e74c3c', label='NS (Not Streaming)'),
+            patches.Patch(color=STATE_COLORS_BY_CODE[WS], label='WS (WiFi Source)'),
+            patches.Patch(color=STATE_COLORS_BY_CODE[DS], label='DS (DSRC Connected)'),
+            patches.Patch(color=STATE_COLORS_BY_CODE[CS], label='CS (Cellular)'),
+            patches.Patch(color=STATE_COLORS_BY_CODE[NS], label='NS (Not Streaming)'),
             patches.Patch(facecolor='white', edgecolor='black', label='Vehicle Number (V#)')
         ]
         
@@ -191,53 +248,50 @@ class SimulationServer:
             framealpha=1
         )
     
+    def _drain(self):
+        # Take everything queued so far without racing empty() against producers
+        cmds = []
+        try:
+            while True:
+                cmds.append(self.command_queue.get_nowait())
+        except Empty:
+            pass
+        return cmds
+    
     def update_visualization(self, frame):
-        # Process any pending commands
-        while not self.command_queue.empty():
-            cmd = self.command_queue.get()
-            self.process_command(cmd)
-            self.need_refresh = True  # Set refresh flag when commands are processed
-        
-        # Only update if there are changes or refresh is needed
-        if not self.need_refresh and frame % 10 != 0:  # Update every 10 frames if no changes
-            return self.vehicle_markers + self.vehicle_labels + [x for x in self.connection_lines if x is not None]
-        
-        self.need_refresh = False  # Reset refresh flag
-        
-        # Clear previous connection lines
-        for line in self.connection_lines:
-            if line is not None:
-                line.remove()
-        self.connection_lines = []
-        
-        # Update all vehicle states first
-        for v in self.vehicles:
-            v.broadcast_state()
-            v.update_state()
+        with self.state_lock:
+            # Apply every pending command, then recompute states once
+            for cmd in self._drain():
+                self.process_command(cmd)
+            if self.need_refresh:
+                self.recompute_states()
+            elif self._moved:
+                self.recompute_states(self._affected_rows())
+            self._moved.clear()
+            
+            # Nothing moved or changed state: leave the artists as they are
+            if not self._dirty and not self.need_refresh:
+                return self._cached_artists
+            
+            self._dirty = False
+            self.need_refresh = False  # Reset refresh flag
         
-        # Then update visualization
-        for i, v in enumerate(self.vehicles):
-            self.vehicle_markers[i].set_offsets([v.position])
-            self.vehicle_markers[i].set_color(self.state_colors[v.state])
-            self.vehicle_labels[i].set_position((v.position[0], v.position[1] - 10))
+        # Then update visualization, reading each array once per redraw
+        positions = self.pos.tolist()
+        sources = self.recv_from.tolist()
+        for i, ((x, y), state) in enumerate(zip(positions, self.state.tolist())):
+            self.vehicle_markers[i].set_offsets([(x, y)])
+            self.vehicle_markers[i].set_color(STATE_COLORS_BY_CODE[state])
+            self.vehicle_labels[i].set_position((x, y - 10))
             
-            if v.state == 'DS':
-                source_pos = next((n.position for n in self.vehicles if n.vehicle_id == v.received_from), None)
-                if source_pos:
-                    line, = self.ax.plot(
-                        [v.position[0], source_pos[0]],
-                        [v.position[1], source_pos[1]],
-                        color='#3498db', linestyle='--', 
-                        linewidth=2.5, alpha=0.7,
-                        zorder=2
-                    )
-                    self.connection_lines.append(line)
-                else:
-                    self.connection_lines.append(None)
+            if state == DS:
+                # vehicle_id doubles as the row index
+                source_x, source_y = positions[sources[i]]
+                self.connection_lines[i].set_data([x, source_x], [y, source_y])
             else:
-                self.connection_lines.append(None)
+                self.connection_lines[i].set_data([], [])
         
-        return self.vehicle_markers + self.vehicle_labels + [x for x in self.connection_lines if x is not None]
+        return self._cached_artists
     
     def process_command(self, cmd):
         try:
@@ -248,6 +302,9 @@ class SimulationServer:
                 y = cmd['y']
                 if 0 <= vid < len(self.vehicles):
                     self.vehicles[vid].move((x, y))
+                    self._moved.add(vid)
+                    self._status_cache.clear()
+                    self._dirty = True
             elif cmd_type == 'status':
                 pass  # Handled in client handler
             elif cmd_type == 'refresh':
@@ -256,40 +313,146 @@ class SimulationServer:
             print(f"Error processing command: {e}")
     
     def get_status(self):
-        return [v.to_dict() for v in self.vehicles]
+        return [
+            {
+                'vehicle_id': vid,
+                'position': tuple(position),
+                'state': STATE_NAMES[state],
+                'wifi_available': wifi,
+                'cellular_available': cell,
+                'received_from': source if source >= 0 else None,
+                'is_streaming': state != NS
+            }
+            for vid, position, state, wifi, cell, source in zip(
+                range(len(self.vehicles)), self.pos.tolist(), self.state.tolist(),
+                self.wifi.tolist(), self.cell.tolist(), self.recv_from.tolist()
+            )
+        ]
     
-    def handle_client(self, conn, addr):
-        print(f"Connected by {addr}")
+    def get_status_frame(self):
+        # Packed status records for MessagePack clients, filled column-wise
+        records = np.empty(len(self.vehicles), dtype=STATUS_DTYPE)
+        records['vehicle_id'] = np.arange(len(self.vehicles))
+        records['x'] = self.pos[:, 0]
+        records['y'] = self.pos[:, 1]
+        records['state'] = self.state
+        records['flags'] = (self.wifi * FLAG_WIFI |
+                            self.cell * FLAG_CELLULAR |
+                            (self.state != NS) * FLAG_STREAMING)
+        records['received_from'] = self.recv_from
+        return records.tobytes()
+    
+    def get_status_response(self, content_type):
+        # Serialize once per state change; repeated polls reuse the bytes
+        with self.state_lock:
+            response = self._status_cache.get(content_type)
+            if response is None:
+                # JSON cannot carry raw bytes, so JSON clients get the dict form
+                data = self.get_status_frame() if content_type == MSGPACK else self.get_status()
+                response = frame(encode({'status': 'success', 'data': data}, content_type))
+                self._status_cache[content_type] = response
+            return response
+    
+    def handle_message(self, data):
+        # Returns the framed reply, ready to send
+        content_type = bytes(data[:1])
         try:
-            while self.running:
-                data = conn.recv(1024).decode('utf-8')
-                if not data:
-                    break
-                
-                try:
-                    cmd = json.loads(data)
-                    if cmd.get('type') == 'status':
-                        response = json.dumps({'status': 'success', 'data': self.get_status()})
-                    else:
-                        self.command_queue.put(cmd)
-                        response = json.dumps({'status': 'success', 'message': 'Command queued'})
-                    
-                    conn.sendall(response.encode('utf-8'))
-                except json.JSONDecodeError:
-                    conn.sendall(json.dumps({'status': 'error', 'message': 'Invalid JSON'}).encode('utf-8'))
-        except ConnectionResetError:
-            print(f"Client {addr} disconnected abruptly")
-        finally:
+            content_type, cmd = decode(data)
+            if not isinstance(cmd, dict):
+                return self._ERR_INVALID[content_type]
+            if cmd.get('type') == 'status':
+                return self.get_status_response(content_type)
+            self.command_queue.put(cmd)
+            return self._OK_QUEUED[content_type]
+        except ValueError:
+            # Covers both orjson.JSONDecodeError and msgpack unpack errors
+            return self._ERR_INVALID.get(content_type, self._ERR_INVALID[MSGPACK])
+    
+    def _accept(self):
+        try:
+            conn, addr = self.server_socket.accept()
+        except BlockingIOError:
+            return
+        except OSError as e:
+            # e.g. EMFILE or ECONNABORTED; keep serving existing clients
+            print(f"Accept error: {e}")
+            return
+        try:
+            conn.setblocking(False)
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError as e:
+            print(f"Error setting up client {addr}: {e}")
             conn.close()
-            print(f"Connection with {addr} closed")
+            return
+        print(f"Connected by {addr}")
+        self.selector.register(conn, selectors.EVENT_READ, ClientConnection(conn, addr))
+    
+    def _on_readable(self, client):
+        if client.filled == len(client.inbound):
+            client.grow()
+        try:
+            n = client.conn.recv_into(client.view[client.filled:])
+        except BlockingIOError:
+            return
+        except OSError:
+            print(f"Client {client.addr} disconnected abruptly")
+            self._close_client(client)
+            return
+        if n == 0:
+            self._close_client(client)
+            return
+        client.filled += n
+        
+        # Answer every complete frame received so far, parsing in place
+        start = 0
+        while client.filled - start >= 4:
+            size = int.from_bytes(client.view[start:start + 4], 'big')
+            end = start + 4 + size
+            if end > client.filled:
+                break
+            client.outbound.append(self.handle_message(client.view[start + 4:end]))
+            start = end
+        
+        # Move any partial frame to the front of the buffer
+        if start:
+            remaining = client.filled - start
+            client.inbound[:remaining] = bytes(client.view[start:client.filled])
+            client.filled = remaining
+        self._flush(client)
+    
+    def _flush(self, client):
+        while client.outbound:
+            pending = client.outbound[0]
+            try:
+                sent = client.conn.send(pending)
+            except BlockingIOError:
+                break
+            except OSError:
+                print(f"Client {client.addr} disconnected abruptly")
+                self._close_client(client)
+                return
+            if sent < len(pending):
+                client.outbound[0] = memoryview(pending)[sent:]
+                break
+            client.outbound.popleft()
+        
+        # Stop reading a client while its replies are still pending, so one
+        # that never reads cannot grow the outbound queue without bound
+        events = selectors.EVENT_WRITE if client.outbound else selectors.EVENT_READ
+        self.selector.modify(client.conn, events, client)
+    
+    def _close_client(self, client):
+        self.selector.unregister(client.conn)
+        client.conn.close()
+        print(f"Connection with {client.addr} closed")
     
     def cleanup(self):
         print("Cleaning up resources...")
         self.running = False
         
-        # Close all client connections
-        for thread in self.client_threads:
-            thread.join()
+        # Let the selector loop close client connections and exit
+        if self.server_thread:
+            self.server_thread.join()
         
         # Close server socket
         if hasattr(self, 'server_socket') and self.server_socket:
@@ -312,15 +475,16 @@ class SimulationServer:
             self.server_socket.listen()
             print(f"Server started on {self.host}:{self.port}")
             
-            # Start animation with a longer interval to reduce CPU usage
+            # Start animation with a longer interval to reduce CPU usage; frames
+            # run indefinitely and are never cached since nothing replays them
             self.ani = FuncAnimation(
                 self.fig, self.update_visualization,
-                frames=100, interval=500, blit=False, repeat=True
+                interval=1000, blit=True, cache_frame_data=False
             )
             
             # Start server thread
-            server_thread = threading.Thread(target=self.accept_connections, daemon=True)
-            server_thread.start()
+            self.server_thread = threading.Thread(target=self.accept_connections, daemon=True)
+            self.server_thread.start()
             
             # Set up proper closing handler
             def on_close(event):
@@ -336,17 +500,38 @@ class SimulationServer:
             self.cleanup()
     
     def accept_connections(self):
+        # A single selector loop services the listening socket and all clients
+        self.selector = selectors.DefaultSelector()
+        self.server_socket.setblocking(False)
+        self.selector.register(self.server_socket, selectors.EVENT_READ)
+        
         while self.running:
             try:
-                conn, addr = self.server_socket.accept()
-                client_thread = threading.Thread(target=self.handle_client, args=(conn, addr))
-                client_thread.start()
-                self.client_threads.append(client_thread)
+                events = self.selector.select(timeout=0.5)
             except OSError as e:
                 if self.running:
                     print(f"Connection error: {e}")
                 break
+            
+            for key, mask in events:
+                if key.fileobj is self.server_socket:
+                    self._accept()
+                    continue
+                try:
+                    if mask & selectors.EVENT_READ:
+                        self._on_readable(key.data)
+                    if mask & selectors.EVENT_WRITE and key.data.conn.fileno() != -1:
+                        self._flush(key.data)
+                except Exception as e:
+                    # Drop only the offending client; the loop serves everyone
+                    print(f"Error serving client {key.data.addr}: {e}")
+                    if key.data.conn.fileno() != -1:
+                        self._close_client(key.data)
         
+        for key in list(self.selector.get_map().values()):
+            if key.fileobj is not self.server_socket:
+                key.fileobj.close()
+        self.selector.close()
         print("Stopped accepting new connections")
 
 if __name__ == "__main__":